@@ -1,68 +1,102 @@
 import bpy
+from bpy_extras import anim_utils
 
 import math
-import random
-
-
-class OctreeNode:
-    def __init__(self, origin, size, depth, max_depth):
-        self.origin = origin
-        self.size = size
-        self.depth = depth
-        self.max_depth = max_depth
-        self.children = []
-
-    def split(self):
-        if self.depth == 0:
-            return
-
-        step = self.size / 2.0
-        for dx in [-0.5, 0.5]:
-            for dy in [-0.5, 0.5]:
-                for dz in [-0.5, 0.5]:
-                    offset = (dx * step, dy * step, dz * step)
-                    child_origin = tuple(sum(i) for i in zip(self.origin, offset))
-                    child = OctreeNode(child_origin, step, self.depth - 1, self.max_depth)
-                    self.children.append(child)
-
-def init_octree(node, split_prob, ior, ior_stdev, roughness):
-    do_split = node.depth == node.max_depth or random.random() < split_prob
-
-    if node.depth == 0 or not do_split:
-        size = node.size
-        location = node.origin
-
-        colors = [(0, 1, 1, 1), (1, 0, 1, 1), (1, 1, 0, 1), (1, 1, 1, 1), (1, 1, 1, 1)]
-        color = random.choice(colors)
-
-        bpy.ops.mesh.primitive_cube_add(size=size, enter_editmode=False, align='WORLD', location=location)
-        cube = bpy.context.active_object
-        cube.parent = bpy.data.objects["OctreeEmpty"]
-        assign_material(cube, color, ior, ior_stdev, roughness)
-        return
-
-    node.split()
-    for child in node.children:
-        init_octree(child, split_prob, ior, ior_stdev, roughness)
-
-def get_octree_bounds(node):
-    """Recursively find the minimum and maximum bounds of the octree."""
-    half_size = node.size / 2.0
-    min_bound = tuple(o - half_size for o in node.origin)
-    max_bound = tuple(o + half_size for o in node.origin)
-
-    if not node.children:
-        return min_bound, max_bound
-
-    for child in node.children:
-        child_min, child_max = get_octree_bounds(child)
-        min_bound = tuple(min(min_bound[i], child_min[i]) for i in range(3))
-        max_bound = tuple(max(max_bound[i], child_max[i]) for i in range(3))
 
-    return min_bound, max_bound
-
-# Assigns a glass material to an object
-def assign_material(obj, color, ior, ior_stdev, roughness):
+import numpy as np
+
+
+# Offsets of the 8 children of a node in units of its child size, which are
+# also the unit cube corners, indexed by (x, y, z) bits with 0 -> -0.5 and 1 -> +0.5
+_CHILD_OFFSETS = tuple((dx, dy, dz) for dx in (-0.5, 0.5) for dy in (-0.5, 0.5) for dz in (-0.5, 0.5))
+CUBE_VERTS = np.array(_CHILD_OFFSETS, dtype=np.float32)
+
+# Outward-facing quads of the unit cube as indices into CUBE_VERTS
+CUBE_FACES = np.array([
+    (0, 1, 3, 2), (4, 6, 7, 5),  # -X, +X
+    (0, 4, 5, 1), (2, 3, 7, 6),  # -Y, +Y
+    (0, 2, 6, 4), (1, 5, 7, 3),  # -Z, +Z
+], dtype=np.int32)
+
+# Every octree is rooted at the same cube
+ROOT_ORIGIN = (0, 0, 0)
+ROOT_SIZE = 2
+
+# Rotation that stands the octree on a corner, and the quarter turn used by the lights
+_ROT_X = math.radians(45)
+_ROT_Y = math.atan(1 / math.sqrt(2))  # Roughly 35.264 degrees
+_PI_OVER_2 = math.pi / 2
+
+LEAF_COLORS = [(0, 1, 1, 1), (1, 0, 1, 1), (1, 1, 0, 1), (1, 1, 1, 1), (1, 1, 1, 1)]
+
+# Glass materials shared between leaf cubes, keyed by (color, ior bucket, roughness)
+_mat_cache = {}
+
+
+def build_leaves(root_origin, root_size, max_depth, split_prob, rng):
+    """Subdivide the root cube level by level and return an (N, 4) array of leaf (x, y, z, size)."""
+    frontier = np.array([(*root_origin, root_size)], dtype=np.float64)
+    leaves = []
+
+    for depth in range(max_depth, -1, -1):
+        if depth == 0:
+            do_split = np.zeros(len(frontier), dtype=bool)
+        elif depth == max_depth:
+            do_split = np.ones(len(frontier), dtype=bool)
+        else:
+            do_split = rng.random(len(frontier)) < split_prob
+
+        leaves.append(frontier[~do_split])
+        parents = frontier[do_split]
+        if len(parents) == 0:
+            break
+
+        # Children sit at the parent's cube corners scaled by half its size
+        step = parents[:, 3] / 2.0
+        children = np.empty((len(parents), 8, 4), dtype=np.float64)
+        children[:, :, :3] = parents[:, None, :3] + CUBE_VERTS[None, :, :] * step[:, None, None]
+        children[:, :, 3] = step[:, None]
+        frontier = children.reshape(-1, 4)
+
+    return np.concatenate(leaves)
+
+def build_cube_mesh(name, origins, sizes):
+    """Build a single mesh holding one axis-aligned cube per (origin, size) pair."""
+    count = len(sizes)
+    coords = origins[:, None, :] + sizes[:, None, None] * CUBE_VERTS[None, :, :]
+    loops = np.arange(count, dtype=np.int32)[:, None, None] * 8 + CUBE_FACES[None, :, :]
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(8 * count)
+    mesh.vertices.foreach_set("co", coords.astype(np.float32).ravel())
+    mesh.loops.add(24 * count)
+    mesh.loops.foreach_set("vertex_index", loops.ravel())
+    mesh.polygons.add(6 * count)
+    mesh.polygons.foreach_set("loop_start", np.arange(0, 24 * count, 4, dtype=np.int32))
+    if bpy.app.version < (4, 0, 0):
+        # loop_total is derived from loop_start (and read-only) since 4.0
+        mesh.polygons.foreach_set("loop_total", np.full(6 * count, 4, dtype=np.int32))
+    mesh.update(calc_edges=True)
+    return mesh
+
+def build_octree_leaves(leaves, colors, iors, roughness, collection):
+    """Create one object containing every leaf cube, sharing materials between leaves."""
+    mesh = build_cube_mesh("OctreeLeaves", leaves[:, :3], leaves[:, 3])
+
+    # One material slot per distinct (color, IOR bucket), looked up per leaf
+    keys = np.column_stack((colors, np.round(iors, 2)))
+    slot_keys, leaf_slots = np.unique(keys, axis=0, return_inverse=True)
+    for *color, ior in slot_keys.tolist():
+        mesh.materials.append(get_glass_material(color, ior, roughness))
+    mesh.polygons.foreach_set("material_index", np.repeat(leaf_slots.ravel().astype(np.int32), 6))
+
+    leaves_obj = bpy.data.objects.new("OctreeLeaves", mesh)
+    collection.objects.link(leaves_obj)
+    leaves_obj.parent = bpy.data.objects["OctreeEmpty"]
+    return leaves_obj
+
+# Creates a glass material with the given color, IOR and roughness
+def create_glass_material(color, ior, roughness):
     mat = bpy.data.materials.new(name="GlassMat")
     mat.use_nodes = True
     nodes = mat.node_tree.nodes
@@ -71,30 +105,42 @@ def assign_material(obj, color, ior, ior_stdev, roughness):
     shader = nodes.new(type='ShaderNodeBsdfGlass')
     shader.inputs[0].default_value = color
     shader.inputs[1].default_value = roughness
-    shader.inputs[2].default_value = random.gauss(ior, ior_stdev)
+    shader.inputs[2].default_value = ior
     shader.location = (0,0)
 
     output = nodes.new(type='ShaderNodeOutputMaterial')
     output.location = (400,0)
 
     mat.node_tree.links.new(shader.outputs[0], output.inputs[0])
-    obj.data.materials.append(mat)
+    return mat
+
+# Returns a shared glass material, with the IOR rounded so that similar leaves reuse it
+def get_glass_material(color, ior, roughness):
+    key = (tuple(color), round(ior, 2), round(roughness, 3))
+    if key not in _mat_cache:
+        _mat_cache[key] = create_glass_material(*key)
+    return _mat_cache[key]
+
+# Assigns a glass material to an object
+def assign_material(obj, color, ior, roughness):
+    obj.data.materials.append(create_glass_material(color, ior, roughness))
 
 def clear_scene():
     # Clearing cubes
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.ops.object.select_by_type(type='MESH')
-    bpy.ops.object.delete()
+    for obj in [o for o in bpy.data.objects if o.type == 'MESH']:
+        bpy.data.objects.remove(obj, do_unlink=True)
+
+    # Clearing the collection holding the octree
+    if "Octree" in bpy.data.collections:
+        bpy.data.collections.remove(bpy.data.collections["Octree"])
 
     # Clearing the OctreeEmpty and its data
     if "OctreeEmpty" in bpy.data.objects:
-        bpy.data.objects["OctreeEmpty"].select_set(True)
-        bpy.ops.object.delete()
+        bpy.data.objects.remove(bpy.data.objects["OctreeEmpty"], do_unlink=True)
 
     # Clearing the Octree camera and its data
     if "OctreeCam" in bpy.data.objects:
-        bpy.data.objects["OctreeCam"].select_set(True)
-        bpy.ops.object.delete()
+        bpy.data.objects.remove(bpy.data.objects["OctreeCam"], do_unlink=True)
 
     if "OctreeCam" in bpy.data.cameras:
         bpy.data.cameras.remove(bpy.data.cameras["OctreeCam"])
@@ -103,11 +149,16 @@ def clear_scene():
     light_names = ["DichroicTopLight", "DichroicSideLight1", "DichroicSideLight2"]
     for light_name in light_names:
         if light_name in bpy.data.objects:
-            bpy.data.objects[light_name].select_set(True)
-            bpy.ops.object.delete()
+            bpy.data.objects.remove(bpy.data.objects[light_name], do_unlink=True)
         if light_name + "Data" in bpy.data.lights:
             bpy.data.lights.remove(bpy.data.lights[light_name + "Data"])
 
+    # Purging the meshes and materials left without users
+    for mesh in [m for m in bpy.data.meshes if m.users == 0]:
+        bpy.data.meshes.remove(mesh)
+    for mat in [m for m in bpy.data.materials if m.users == 0]:
+        bpy.data.materials.remove(mat)
+
 # Clear the octree from the scene
 class OT_ClearScene(bpy.types.Operator):
     bl_idname = "scene.clear_octree"
@@ -125,13 +176,9 @@ def rotate_empty():
 
     empty = bpy.data.objects["OctreeEmpty"]
 
-    # Set the rotation values
-    rotation_x = math.radians(45)
-    rotation_y = math.atan(1/math.sqrt(2))  # Roughly 35.264 degrees
-
     # Apply rotations
-    empty.rotation_euler.x = rotation_x
-    empty.rotation_euler.y = rotation_y
+    empty.rotation_euler.x = _ROT_X
+    empty.rotation_euler.y = _ROT_Y
 
 # Generate the octree
 class OT_GenerateOctree(bpy.types.Operator):
@@ -140,11 +187,15 @@ class OT_GenerateOctree(bpy.types.Operator):
 
     def execute(self, context):
         bpy.ops.scene.clear_octree()
+        _mat_cache.clear()
+
+        # Filled off-scene and linked once at the end, so the depsgraph picks
+        # up the whole octree in one update
+        octree_coll = bpy.data.collections.new("Octree")
 
         if "OctreeEmpty" not in bpy.data.objects:
-            bpy.ops.object.empty_add(location=(0,0,0))
-            empty = bpy.context.active_object
-            empty.name = "OctreeEmpty"
+            empty = bpy.data.objects.new("OctreeEmpty", None)
+            octree_coll.objects.link(empty)
 
         depth = context.scene.octree_depth
         split_prob = context.scene.split_prob
@@ -153,55 +204,51 @@ class OT_GenerateOctree(bpy.types.Operator):
         roughness = context.scene.roughness
         encase_thickness = context.scene.encase_thickness
 
-        size = 2
-        origin = (0, 0, 0)
-        root = OctreeNode(origin, size, depth, depth)
-        init_octree(root, split_prob, ior, ior_stdev, roughness)
+        # A seed of 0 gives a different octree on every run
+        rng = np.random.default_rng(context.scene.octree_seed or None)
 
-        min_bound, max_bound = get_octree_bounds(root)
-        center = tuple((min_bound[i] + max_bound[i]) / 2 for i in range(3))
-        extent = max(max_bound[i] - min_bound[i] for i in range(3)) + 2 * encase_thickness
+        leaves = build_leaves(ROOT_ORIGIN, ROOT_SIZE, depth, split_prob, rng)
+        colors = np.array(LEAF_COLORS, dtype=np.float64)[rng.integers(0, len(LEAF_COLORS), len(leaves))]
+        iors = rng.normal(ior, ior_stdev, len(leaves))
+        build_octree_leaves(leaves, colors, iors, roughness, octree_coll)
+
+        # The octree bounds are those of its root cube
+        center = ROOT_ORIGIN
+        extent = ROOT_SIZE + 2 * encase_thickness
 
         # Create the outer box
-        bpy.ops.mesh.primitive_cube_add(size=extent, enter_editmode=False, align='WORLD', location=center)
-        outer_cube = bpy.context.active_object
+        outer_cube = bpy.data.objects.new("OuterCube", build_cube_mesh("OuterCube", np.zeros((1, 3)), np.ones(1)))
+        outer_cube.location = center
+        outer_cube.scale = (extent, extent, extent)
+        octree_coll.objects.link(outer_cube)
         outer_cube.parent = bpy.data.objects["OctreeEmpty"]
-        assign_material(outer_cube, (1, 1, 1, 1), ior, 0.0, roughness / 2) # outer cube doesn't get random ior
+        assign_material(outer_cube, (1, 1, 1, 1), ior, roughness / 2) # outer cube doesn't get random ior
 
         rotate_empty()
+        context.scene.collection.children.link(octree_coll)
 
         return {'FINISHED'}
 
 
+def add_sun_light(name, location, rotation):
+    """Return the named sun light, creating it at the given placement if it doesn't exist."""
+    if name in bpy.data.objects:
+        return bpy.data.objects[name]
+
+    light_data = bpy.data.lights.new(name=name + "Data", type='SUN')
+    light_data.energy = 10
+    light = bpy.data.objects.new(name, light_data)
+    light.location = location
+    light.rotation_euler = rotation
+    bpy.context.collection.objects.link(light)
+    return light
+
 def setup_lights(center, extent):
     light_distance = extent * 3  # distance to place the lights from the center
 
-    # Top light
-    if "DichroicTopLight" not in bpy.data.objects:
-        bpy.ops.object.light_add(type='SUN', align='WORLD', location=(center[0], center[1], center[2] + light_distance))
-        top_light = bpy.context.active_object
-        top_light.name = "DichroicTopLight"
-        top_light.data.name = "DichroicTopLightData"
-        top_light.data.energy = 10
-        top_light.rotation_euler = (0, 0, 0)
-
-    # Side Light 1
-    if "DichroicSideLight1" not in bpy.data.objects:
-        bpy.ops.object.light_add(type='SUN', align='WORLD', location=(center[0] - light_distance, center[1], center[2]))
-        side_light_1 = bpy.context.active_object
-        side_light_1.name = "DichroicSideLight1"
-        side_light_1.data.name = "DichroicSideLight1Data"
-        side_light_1.data.energy = 10
-        side_light_1.rotation_euler = (0, 3.14159 / 2, 0)
-
-    # Side Light 2
-    if "DichroicSideLight2" not in bpy.data.objects:
-        bpy.ops.object.light_add(type='SUN', align='WORLD', location=(center[0], center[1] - light_distance, center[2]))
-        side_light_2 = bpy.context.active_object
-        side_light_2.name = "DichroicSideLight2"
-        side_light_2.data.name = "DichroicSideLight2Data"
-        side_light_2.data.energy = 10
-        side_light_2.rotation_euler = (3.14159 / 2, 0, 0)
+    top_light = add_sun_light("DichroicTopLight", (center[0], center[1], center[2] + light_distance), (0, 0, 0))
+    side_light_1 = add_sun_light("DichroicSideLight1", (center[0] - light_distance, center[1], center[2]), (0, _PI_OVER_2, 0))
+    side_light_2 = add_sun_light("DichroicSideLight2", (center[0], center[1] - light_distance, center[2]), (_PI_OVER_2, 0, 0))
 
     return [top_light, side_light_1, side_light_2]
 
@@ -209,19 +256,21 @@ def setup_camera_animation(center, extent):
     # Ensure a camera exists or create a new one
     camera_distance = extent * 4  # Adjusting the distance for proper viewport fitting
     if "OctreeCam" not in bpy.data.cameras:
-        bpy.ops.object.camera_add(location=(center[0], center[1] - camera_distance, center[2]))
-        camera = bpy.context.active_object
-        camera.name = "OctreeCam"
-        camera.data.name = "OctreeCam"
+        camera = bpy.data.objects.new("OctreeCam", bpy.data.cameras.new(name="OctreeCam"))
+        camera.location = (center[0], center[1] - camera_distance, center[2])
+        bpy.context.collection.objects.link(camera)
+        # Like camera_add did, render through the new camera if the scene has none
+        if bpy.context.scene.camera is None:
+            bpy.context.scene.camera = camera
     else:
         camera = bpy.data.objects["OctreeCam"]
         camera.location = (center[0], center[1] - camera_distance, center[2])  # Reset camera position
 
     # Create or get an Empty at the center
     if "TargetEmpty" not in bpy.data.objects:
-        bpy.ops.object.empty_add(location=center)
-        empty = bpy.context.active_object
-        empty.name = "TargetEmpty"
+        empty = bpy.data.objects.new("TargetEmpty", None)
+        empty.location = center
+        bpy.context.collection.objects.link(empty)
     else:
         empty = bpy.data.objects["TargetEmpty"]
         empty.location = center  # Reset empty's position
@@ -237,12 +286,34 @@ def setup_camera_animation(center, extent):
 
     # Keyframe the camera to rotate around the center
     frames_per_revolution = 300
-    for frame in range(0, frames_per_revolution + 1, 10):
-        angle = (frame / frames_per_revolution) * 2 * 3.14159
-        x = center[0] + camera_distance * math.cos(angle)
-        y = center[1] + camera_distance * math.sin(angle)
-        camera.location = (x, y, center[2])
-        camera.keyframe_insert(data_path="location", frame=frame)
+    frames = np.arange(0, frames_per_revolution + 1, 10)
+    angles = frames / frames_per_revolution * 2 * np.pi
+    locations = (
+        center[0] + camera_distance * np.cos(angles),
+        center[1] + camera_distance * np.sin(angles),
+        np.full(len(frames), center[2]),
+    )
+
+    animation_data = camera.animation_data_create()
+    if animation_data.action is None:
+        animation_data.action = bpy.data.actions.new(name="OctreeCamAction")
+    action = animation_data.action
+    if bpy.app.version >= (4, 4, 0):
+        # Action.fcurves is gone since 4.4 layered actions, curves live in the slot's channelbag
+        if animation_data.action_slot is None:
+            animation_data.action_slot = action.slots.new(id_type='OBJECT', name=camera.name)
+        fcurves = anim_utils.action_ensure_channelbag_for_slot(action, animation_data.action_slot).fcurves
+    else:
+        fcurves = action.fcurves
+    for index, values in enumerate(locations):
+        # Replace any keyframes left over from a previous setup
+        fcurve = fcurves.find("location", index=index)
+        if fcurve is not None:
+            fcurves.remove(fcurve)
+        fcurve = fcurves.new("location", index=index)
+        fcurve.keyframe_points.add(len(frames))
+        fcurve.keyframe_points.foreach_set("co", np.column_stack((frames, values)).astype(np.float32).ravel())
+        fcurve.update()
 
     # Setup lights for desired reflections and refractions
     setup_lights(center, extent)
@@ -252,11 +323,9 @@ class OT_SetupAnimation(bpy.types.Operator):
     bl_label = "Setup Animation"
 
     def execute(self, context):
-        # Get the octree bounds
-        root = OctreeNode((0, 0, 0), 2, context.scene.octree_depth, context.scene.octree_depth)
-        min_bound, max_bound = get_octree_bounds(root)
-        center = tuple((min_bound[i] + max_bound[i]) / 2 for i in range(3))
-        extent = max(max_bound[i] - min_bound[i] for i in range(3))
+        # The octree bounds are those of its root cube
+        center = ROOT_ORIGIN
+        extent = ROOT_SIZE
 
         # Setup camera animation
         setup_camera_animation(center, extent)
@@ -274,18 +343,23 @@ class OctreePanel(bpy.types.Panel):
 
     def draw(self, context):
         layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
         scene = context.scene
 
-        layout.prop(scene, "octree_depth")
-        layout.prop(scene, "split_prob")
-        layout.prop(scene, "roughness")
-        layout.prop(scene, "ior")
-        layout.prop(scene, "ior_stdev")
-        layout.prop(scene, "encase_thickness")
+        col = layout.column(align=True)
+        col.prop(scene, "octree_depth")
+        col.prop(scene, "split_prob")
+        col.prop(scene, "roughness")
+        col.prop(scene, "ior")
+        col.prop(scene, "ior_stdev")
+        col.prop(scene, "encase_thickness")
+        col.prop(scene, "octree_seed")
 
-        layout.operator("scene.setup_animation")
-        layout.operator("scene.generate_octree")
-        layout.operator("scene.clear_octree")
+        row = layout.row(align=True)
+        row.operator("scene.setup_animation")
+        row.operator("scene.generate_octree")
+        row.operator("scene.clear_octree")
 
 classes = [OT_ClearScene, OT_GenerateOctree, OT_SetupAnimation, OctreePanel]
 
@@ -300,6 +374,7 @@ def register():
     bpy.types.Scene.ior = bpy.props.FloatProperty(name="IOR", default=1.45, min=1, max=3)
     bpy.types.Scene.ior_stdev = bpy.props.FloatProperty(name="IOR stdev", default=0.5, min=0, max=1)
     bpy.types.Scene.encase_thickness = bpy.props.FloatProperty(name="encase thickness", default=0.3, min=0)
+    bpy.types.Scene.octree_seed = bpy.props.IntProperty(name="seed", default=0, min=0, description="Random seed, 0 for a new octree on every run")
 
 def unregister():
     from bpy.utils import unregister_class
@@ -311,6 +386,7 @@ def unregister():
     del bpy.types.Scene.ior
     del bpy.types.Scene.ior_stdev
     del bpy.types.Scene.encase_thickness
+    del bpy.types.Scene.octree_seed
 
 if __name__ == "__main__":
     register()